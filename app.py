@@ -1,6 +1,9 @@
+import functools
 import logging
 import os
-from datetime import datetime
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from flask import (
     Flask,
@@ -12,70 +15,315 @@ from flask import (
     request,
     url_for,
 )
+import orjson
 import requests
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
-from markupsafe import Markup
-from sqlalchemy import inspect, text
+from requests.adapters import HTTPAdapter
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup, escape
+from sqlalchemy import and_, bindparam, case, event, func, insert, inspect, or_, select, text, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, joinedload, raiseload
+from urllib3.util.retry import Retry
 from werkzeug.exceptions import HTTPException
 
 
 load_dotenv()
 
 
+class ORJSONProvider(DefaultJSONProvider):
+    """
+    Serializa y parsea JSON con orjson (implementado en C).
+    """
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        # La sesión de Flask necesita object_hook para restaurar tuplas, fechas, etc.
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///inbox.db"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SECRET_KEY"] = os.environ.get("FLASK_SECRET_KEY", "cambia-esta-clave")
+app.config["TEMPLATES_AUTO_RELOAD"] = os.environ.get("FLASK_ENV") == "development"
+
+# Las plantillas compiladas se reutilizan entre reinicios de los workers.
+jinja_cache_dir = os.path.join(app.instance_path, "jinja_cache")
+os.makedirs(jinja_cache_dir, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(jinja_cache_dir)
+
+# Sin autoflush: cada handler hace flush/commit explícito una sola vez.
+db = SQLAlchemy(app, session_options={"autoflush": False})
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-20000",
+)
+
+
+def apply_sqlite_pragmas(dbapi_connection, _connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
 
-db = SQLAlchemy(app)
+
+with app.app_context():
+    # WAL permite que el dashboard lea mientras los webhooks escriben.
+    if db.engine.dialect.name == "sqlite":
+        event.listen(db.engine, "connect", apply_sqlite_pragmas)
 
 logging.basicConfig(level=logging.INFO)
 app.logger.setLevel(logging.INFO)
 
 
+def raise_on_lazy_load(orm_execute_state) -> None:
+    if orm_execute_state.is_select and not (
+        orm_execute_state.is_column_load or orm_execute_state.is_relationship_load
+    ):
+        orm_execute_state.statement = orm_execute_state.statement.options(raiseload("*"))
+
+
+# En desarrollo cualquier carga perezosa de una relación lanza una excepción,
+# así un N+1 (p. ej. message.conversation dentro de un bucle) aparece antes de producción.
+if os.environ.get("FLASK_ENV") == "development":
+    event.listen(Session, "do_orm_execute", raise_on_lazy_load)
+
+
 class Conversation(db.Model):
     __tablename__ = "conversations"
 
     id = db.Column(db.Integer, primary_key=True)
-    contact_number = db.Column(db.String(64), nullable=False, index=True)
+    contact_number = db.Column(db.String(64), nullable=False, unique=True, index=True)
     contact_name = db.Column(db.String(255))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    # created_at/updated_at las genera SQLite (CURRENT_TIMESTAMP, en UTC).
+    created_at = db.Column(
+        db.DateTime, default=func.now(), server_default=func.current_timestamp(), nullable=False
+    )
     updated_at = db.Column(
-        db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False
+        db.DateTime,
+        default=func.now(),
+        onupdate=func.now(),
+        server_default=func.current_timestamp(),
+        nullable=False,
     )
+    # Copia del último mensaje para no consultar messages al listar conversaciones.
+    last_message_text = db.Column(db.Text)
+    last_message_sender = db.Column(db.String(32))
+    last_message_sent_at = db.Column(db.DateTime, index=True)
 
+    # write_only: nunca se cargan todos los mensajes al acceder a la relación.
     messages = db.relationship(
         "Message",
         backref="conversation",
-        lazy="dynamic",
+        lazy="write_only",
         cascade="all, delete-orphan",
     )
 
-    def last_message(self):
-        return self.messages.order_by(Message.sent_at.desc(), Message.id.desc()).first()
+    def register_message(self, message: "Message") -> None:
+        if self.last_message_sent_at is None or message.sent_at >= self.last_message_sent_at:
+            self.last_message_text = message.message_text
+            self.last_message_sender = message.sender_type
+            self.last_message_sent_at = message.sent_at
 
     def unread_count(self):
-        return self.messages.filter_by(sender_type="customer", is_read=False).count()
+        return db.session.scalar(
+            select(func.count(Message.id)).where(
+                Message.conversation_id == self.id,
+                Message.sender_type == "customer",
+                Message.is_read.is_(False),
+            )
+        )
 
 
 class Message(db.Model):
     __tablename__ = "messages"
+    __table_args__ = (
+        db.Index("ix_messages_conv_sent", "conversation_id", "sent_at"),
+        db.Index("ix_messages_ext_conv", "external_id", "conversation_id"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    conversation_id = db.Column(
-        db.Integer, db.ForeignKey("conversations.id"), nullable=False, index=True
-    )
+    conversation_id = db.Column(db.Integer, db.ForeignKey("conversations.id"), nullable=False)
     sender_type = db.Column(db.String(32), nullable=False)  # "customer" o "agent"
     message_text = db.Column(db.Text, nullable=False)
+    # sent_at se genera en Python: la paginación compara (sent_at, id) como texto en
+    # SQLite y todas las filas deben guardarse con el mismo formato (con microsegundos).
     sent_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
-    external_id = db.Column(db.String(128), index=True)
+    external_id = db.Column(db.String(128))
     is_read = db.Column(db.Boolean, default=True, nullable=False, index=True)
+    status = db.Column(db.String(16), default="sent", nullable=False)  # "pending", "sending", "sent" o "failed"
+
+
+# Sentencia compilada una vez y reutilizada (índice único sobre contact_number).
+CONVERSATION_BY_NUMBER = select(Conversation).where(
+    Conversation.contact_number == bindparam("contact_number")
+)
 
 
 GREEN_API_INSTANCE_ID = os.environ.get("GREEN_API_INSTANCE_ID")
 GREEN_API_API_TOKEN = os.environ.get("GREEN_API_API_TOKEN")
 GREEN_API_BASE_URL = os.environ.get("GREEN_API_BASE_URL", "https://api.green-api.com")
-GREEN_API_TIMEOUT = 15
+GREEN_API_TIMEOUT = (3, 15)
+MESSAGES_PAGE_SIZE = 50
+# Un envío que sigue "pending" pasado este tiempo se perdió (p. ej. reinicio del worker).
+PENDING_SEND_TIMEOUT = timedelta(minutes=2)
+# "sending" ya está en curso: un envío dura como mucho ~25 s, así que solo se da por
+# perdido mucho después, cuando el worker que lo reclamó ya no puede terminarlo.
+SENDING_TIMEOUT = timedelta(minutes=10)
+
+# Sesión compartida: reutiliza conexiones TLS con Green API entre envíos.
+# Retry no reintenta POST por defecto, así que no se duplican mensajes.
+green_api_session = requests.Session()
+green_api_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+    ),
+)
+# Los envíos desde el inbox se hacen fuera del hilo de la petición.
+send_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="green-send")
+
+
+def _add_last_message_columns(conn, inspector) -> bool:
+    columns = {col["name"] for col in inspector.get_columns("conversations")}
+    if "last_message_sent_at" in columns:
+        return False
+    conn.execute(text("ALTER TABLE conversations ADD COLUMN last_message_text TEXT"))
+    conn.execute(text("ALTER TABLE conversations ADD COLUMN last_message_sender VARCHAR(32)"))
+    conn.execute(text("ALTER TABLE conversations ADD COLUMN last_message_sent_at DATETIME"))
+    app.logger.info("Columnas last_message_* añadidas a conversations")
+    return True
+
+
+def _merge_duplicate_conversations(conn) -> int:
+    """
+    Fusiona las conversaciones con el mismo contact_number en la de menor id.
+
+    El antiguo SELECT + INSERT de los webhooks podía crear duplicados, que
+    impedirían crear el índice UNIQUE sobre contact_number.
+    """
+    duplicates = conn.execute(
+        text(
+            "SELECT contact_number, MIN(id) FROM conversations "
+            "GROUP BY contact_number HAVING COUNT(*) > 1"
+        )
+    ).all()
+    for contact_number, keep_id in duplicates:
+        params = {"contact_number": contact_number, "keep_id": keep_id}
+        conn.execute(
+            text(
+                """
+                UPDATE messages SET conversation_id = :keep_id
+                WHERE conversation_id IN (
+                    SELECT id FROM conversations
+                    WHERE contact_number = :contact_number AND id != :keep_id
+                )
+                """
+            ),
+            params,
+        )
+        conn.execute(
+            text(
+                """
+                UPDATE conversations SET
+                    created_at = (
+                        SELECT MIN(created_at) FROM conversations
+                        WHERE contact_number = :contact_number
+                    ),
+                    updated_at = (
+                        SELECT MAX(updated_at) FROM conversations
+                        WHERE contact_number = :contact_number
+                    )
+                WHERE id = :keep_id
+                """
+            ),
+            params,
+        )
+        conn.execute(
+            text(
+                "DELETE FROM conversations WHERE contact_number = :contact_number AND id != :keep_id"
+            ),
+            params,
+        )
+    if duplicates:
+        app.logger.warning(
+            "Fusionadas conversaciones duplicadas para %s números: %s",
+            len(duplicates),
+            ", ".join(contact_number for contact_number, _ in duplicates),
+        )
+    return len(duplicates)
+
+
+def _backfill_last_message(conn) -> None:
+    conn.execute(
+        text(
+            """
+            UPDATE conversations SET
+                last_message_text = m.message_text,
+                last_message_sender = m.sender_type,
+                last_message_sent_at = m.sent_at
+            FROM (
+                SELECT id, conversation_id, message_text, sender_type, sent_at,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY conversation_id ORDER BY sent_at DESC, id DESC
+                    ) AS position
+                FROM messages
+            ) AS m
+            WHERE m.conversation_id = conversations.id AND m.position = 1
+            """
+        )
+    )
+
+
+def _sync_indexes(conn, inspector) -> None:
+    """
+    Alinea los índices de la base con los del modelo.
+
+    Borra los índices simples que cubren los compuestos y recrea los que
+    cambiaron de UNIQUE (contact_number).
+    """
+    existing_indexes = {
+        index["name"]: bool(index["unique"])
+        for table in ("conversations", "messages")
+        for index in inspector.get_indexes(table)
+    }
+    model_indexes = [
+        index for table in (Conversation.__table__, Message.__table__) for index in table.indexes
+    ]
+    obsolete_indexes = {"ix_messages_conversation_id", "ix_messages_external_id"} & set(
+        existing_indexes
+    )
+    obsolete_indexes |= {
+        index.name
+        for index in model_indexes
+        if index.name in existing_indexes and existing_indexes[index.name] != index.unique
+    }
+    missing_indexes = [
+        index
+        for index in model_indexes
+        if index.name not in existing_indexes or index.name in obsolete_indexes
+    ]
+    if not (obsolete_indexes or missing_indexes):
+        return
+    for name in obsolete_indexes:
+        conn.execute(text(f"DROP INDEX {name}"))
+    for index in missing_indexes:
+        index.create(conn)
+    conn.execute(text("ANALYZE"))
+    app.logger.info("Índices actualizados")
 
 
 def ensure_database():
@@ -89,13 +337,55 @@ def ensure_database():
                     text("ALTER TABLE messages ADD COLUMN is_read BOOLEAN NOT NULL DEFAULT 1")
                 )
             app.logger.info("Columna is_read añadida a messages")
+        if "status" not in columns:
+            with db.engine.begin() as conn:
+                conn.execute(
+                    text("ALTER TABLE messages ADD COLUMN status VARCHAR(16) NOT NULL DEFAULT 'sent'")
+                )
+            app.logger.info("Columna status añadida a messages")
+
+        with db.engine.begin() as conn:
+            added = _add_last_message_columns(conn, inspector)
+            merged = _merge_duplicate_conversations(conn)
+            if added or merged:
+                _backfill_last_message(conn)
+        with db.engine.begin() as conn:
+            _sync_indexes(conn, inspector)
+
+        failed = fail_stale_pending_messages()
+        db.session.commit()
+        if failed:
+            app.logger.warning("%s mensajes pendientes marcados como no enviados", failed)
+
+
+def fail_stale_pending_messages(
+    conversation_id: int | None = None, message_ids: list[int] | None = None
+) -> int:
+    """
+    Marca como "failed" los envíos "pending" o "sending" que superan su timeout.
+    """
+    now = datetime.utcnow()
+    query = Message.query.filter(
+        or_(
+            and_(Message.status == "pending", Message.sent_at < now - PENDING_SEND_TIMEOUT),
+            and_(Message.status == "sending", Message.sent_at < now - SENDING_TIMEOUT),
+        )
+    )
+    if conversation_id is not None:
+        query = query.filter(Message.conversation_id == conversation_id)
+    if message_ids is not None:
+        query = query.filter(Message.id.in_(message_ids))
+    return query.update({"status": "failed"}, synchronize_session=False)
+
+
+NEWLINE_RE = re.compile(r"\r?\n")
 
 
 @app.template_filter("nl2br")
 def nl2br(value: str) -> str:
     if value is None:
         return ""
-    return Markup(value.replace("\n", "<br>"))
+    return Markup(NEWLINE_RE.sub("<br>", str(escape(value))))
 
 
 @app.template_filter("chat_display")
@@ -116,27 +406,35 @@ def message_to_dict(message: Message) -> dict:
         "sent_at": message.sent_at.isoformat(),
         "sent_at_human": message.sent_at.strftime("%d/%m/%Y %H:%M"),
         "is_read": message.is_read,
+        "status": message.status,
     }
 
 
-def conversation_to_dict(conversation: Conversation) -> dict:
-    last = conversation.last_message()
+def conversation_to_dict(conversation: Conversation, unread_count: int) -> dict:
     display_name = conversation.contact_name or conversation.contact_number
     return {
         "id": conversation.id,
         "display_name": chat_display(display_name),
         "contact_number": conversation.contact_number,
-        "last_message_text": last.message_text if last else "",
-        "last_message_sender": last.sender_type if last else None,
+        "last_message_text": conversation.last_message_text or "",
+        "last_message_sender": conversation.last_message_sender,
         "updated_at": conversation.updated_at.isoformat() if conversation.updated_at else None,
         "updated_at_human": conversation.updated_at.strftime("%d/%m/%Y %H:%M")
         if conversation.updated_at
         else "",
-        "unread_count": conversation.unread_count(),
+        "unread_count": unread_count,
         "url": url_for("conversation_detail", conversation_id=conversation.id),
     }
 
 
+NON_DIGITS_RE = re.compile(r"\D+")
+
+
+@functools.lru_cache(maxsize=4096)
+def _chat_id_from_number(number: str) -> str:
+    return f"{NON_DIGITS_RE.sub('', number)}@c.us"
+
+
 def normalize_chat_id(raw_number: str) -> str:
     """
     Devuelve el chatId en formato requerido por Green API.
@@ -148,11 +446,11 @@ def normalize_chat_id(raw_number: str) -> str:
     if "@" in raw_number:
         return raw_number
 
-    digits = "".join(filter(str.isdigit, raw_number))
-    if not digits:
+    chat_id = _chat_id_from_number(raw_number)
+    if chat_id == "@c.us":
         raise ValueError("El número de WhatsApp debe contener al menos un dígito")
 
-    return f"{digits}@c.us"
+    return chat_id
 
 
 def send_whatsapp_message(chat_id: str, message_text: str) -> requests.Response:
@@ -164,11 +462,63 @@ def send_whatsapp_message(chat_id: str, message_text: str) -> requests.Response:
     url = f"{GREEN_API_BASE_URL}/waInstance{GREEN_API_INSTANCE_ID}/sendMessage/{GREEN_API_API_TOKEN}"
     payload = {"chatId": normalize_chat_id(chat_id), "message": message_text}
 
-    response = requests.post(url, json=payload, timeout=GREEN_API_TIMEOUT)
+    response = green_api_session.post(url, json=payload, timeout=GREEN_API_TIMEOUT)
     response.raise_for_status()
     return response
 
 
+def json_or_empty(response: requests.Response) -> dict:
+    """
+    Devuelve el cuerpo JSON de la respuesta o {} si no lo es.
+    """
+    try:
+        data = orjson.loads(response.content)
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def dispatch_message(message_id: int) -> None:
+    """
+    Envía en segundo plano un mensaje pendiente y guarda el resultado.
+    """
+    with app.app_context():
+        # Se reclama el mensaje antes de enviarlo: si ya no está "pending" (p. ej. se
+        # marcó como fallido por timeout mientras esperaba en la cola) no se envía.
+        claimed = (
+            Message.query.filter_by(id=message_id, status="pending")
+            .update({"status": "sending"}, synchronize_session=False)
+        )
+        db.session.commit()
+        if not claimed:
+            return
+
+        message = db.session.get(Message, message_id, options=[joinedload(Message.conversation)])
+        in_flight = Message.query.filter_by(id=message_id, status="sending")
+
+        try:
+            response = send_whatsapp_message(message.conversation.contact_number, message.message_text)
+            data = json_or_empty(response)
+        except Exception as exc:  # noqa: BLE001
+            app.logger.error("No fue posible enviar el mensaje %s: %s", message_id, exc)
+            in_flight.update({"status": "failed"}, synchronize_session=False)
+            db.session.commit()
+            return
+
+        external_id = data.get("idMessage")
+        in_flight.update(
+            {"status": "sent", "external_id": external_id}, synchronize_session=False
+        )
+        if external_id:
+            # El webhook outgoingMessageReceived puede llegar antes que la respuesta del envío.
+            Message.query.filter(
+                Message.conversation_id == message.conversation_id,
+                Message.external_id == external_id,
+                Message.id != message_id,
+            ).delete(synchronize_session=False)
+        db.session.commit()
+
+
 def fetch_green_contacts() -> list[dict]:
     if not (GREEN_API_INSTANCE_ID and GREEN_API_API_TOKEN):
         raise RuntimeError(
@@ -176,7 +526,7 @@ def fetch_green_contacts() -> list[dict]:
         )
 
     url = f"{GREEN_API_BASE_URL}/waInstance{GREEN_API_INSTANCE_ID}/getContacts/{GREEN_API_API_TOKEN}"
-    response = requests.get(url, timeout=GREEN_API_TIMEOUT)
+    response = green_api_session.get(url, timeout=GREEN_API_TIMEOUT)
     response.raise_for_status()
     data = response.json()
     contacts = data.get("contacts") if isinstance(data, dict) else None
@@ -223,10 +573,32 @@ def extract_incoming_text(message_data: dict) -> tuple[str | None, str]:
     return None, type_message or "desconocido"
 
 
+def conversations_overview() -> list[tuple[Conversation, int]]:
+    """
+    Devuelve (conversación, no leídos) en una sola consulta.
+    """
+    unread = (
+        select(Message.conversation_id, func.count(Message.id).label("unread"))
+        .where(Message.sender_type == "customer", Message.is_read.is_(False))
+        .group_by(Message.conversation_id)
+        .subquery()
+    )
+    rows = (
+        db.session.query(Conversation, unread.c.unread)
+        .outerjoin(unread, unread.c.conversation_id == Conversation.id)
+        .order_by(
+            # Sin mensajes todavía, la conversación se ordena por su fecha de creación.
+            func.coalesce(Conversation.last_message_sent_at, Conversation.created_at).desc(),
+            Conversation.updated_at.desc(),
+        )
+        .all()
+    )
+    return [(conversation, unread_count or 0) for conversation, unread_count in rows]
+
+
 @app.route("/")
 def dashboard():
-    conversations = Conversation.query.order_by(Conversation.updated_at.desc()).all()
-    return render_template("index.html", conversations=conversations)
+    return render_template("index.html", conversations=conversations_overview())
 
 
 @app.route("/conversation/<int:conversation_id>", methods=["GET", "POST"])
@@ -239,43 +611,53 @@ def conversation_detail(conversation_id: int):
         if not message_text:
             abort(400, description="El mensaje no puede estar vacío")
 
-        try:
-            response = send_whatsapp_message(conversation.contact_number, message_text)
-            data = response.json() if response.headers.get("content-type") == "application/json" else {}
-            external_id = data.get("idMessage")
-        except requests.exceptions.HTTPError as exc:
-            abort(exc.response.status_code, description=f"Error al enviar mensaje: {exc}")
-        except Exception as exc:  # noqa: BLE001
-            abort(500, description=f"No fue posible enviar el mensaje: {exc}")
-
         message = Message(
             conversation_id=conversation.id,
             sender_type="agent",
             message_text=message_text,
             sent_at=datetime.utcnow(),
-            external_id=external_id,
             is_read=True,
+            status="pending",
         )
-        conversation.updated_at = datetime.utcnow()
+        conversation.updated_at = func.now()
+        conversation.register_message(message)
 
         db.session.add(message)
         db.session.commit()
+        send_executor.submit(dispatch_message, message.id)
 
         return redirect(url_for("conversation_detail", conversation_id=conversation.id))
 
-    unread_messages = conversation.messages.filter_by(
-        sender_type="customer", is_read=False
+    unread_messages = Message.query.filter_by(
+        conversation_id=conversation.id, sender_type="customer", is_read=False
     ).all()
     if unread_messages:
         for msg in unread_messages:
             msg.is_read = True
         db.session.commit()
 
-    messages = conversation.messages.order_by(Message.sent_at.asc(), Message.id.asc()).all()
+    # Paginación por clave (sent_at, id): usa ix_messages_conv_sent sin OFFSET.
+    before_id = request.args.get("before", type=int)
+    messages_query = Message.query.filter_by(conversation_id=conversation.id)
+    if before_id is not None:
+        before = Message.query.filter_by(id=before_id, conversation_id=conversation.id).first_or_404()
+        messages_query = messages_query.filter(
+            tuple_(Message.sent_at, Message.id) < tuple_(before.sent_at, before.id)
+        )
+    messages = (
+        messages_query.order_by(Message.sent_at.desc(), Message.id.desc())
+        .limit(MESSAGES_PAGE_SIZE + 1)
+        .all()
+    )
+    has_older = len(messages) > MESSAGES_PAGE_SIZE
+    messages = messages[:MESSAGES_PAGE_SIZE][::-1]
+
     return render_template(
         "conversation.html",
         conversation=conversation,
         messages=messages,
+        has_older=has_older,
+        is_latest_page=before_id is None,
     )
 
 
@@ -296,16 +678,19 @@ def new_conversation():
             flash(str(exc), "danger")
             return render_template("new_conversation.html")
 
-        conversation = Conversation.query.filter_by(contact_number=chat_id).first()
+        conversation = db.session.scalar(CONVERSATION_BY_NUMBER, {"contact_number": chat_id})
         if conversation:
             flash("Ya existe una conversación con ese número. Te redirigimos.", "info")
             return redirect(url_for("conversation_detail", conversation_id=conversation.id))
 
+        # created_at con microsegundos, como last_message_sent_at: el dashboard ordena por
+        # COALESCE de ambos y SQLite compara las fechas como texto.
+        created_at = datetime.utcnow()
         conversation = Conversation(
             contact_number=chat_id,
             contact_name=contact_name,
-            created_at=datetime.utcnow(),
-            updated_at=datetime.utcnow(),
+            created_at=created_at,
+            updated_at=created_at,
         )
         db.session.add(conversation)
         db.session.flush()
@@ -313,7 +698,7 @@ def new_conversation():
         if initial_message:
             try:
                 response = send_whatsapp_message(chat_id, initial_message)
-                data = response.json() if response.headers.get("content-type") == "application/json" else {}
+                data = json_or_empty(response)
                 external_id = data.get("idMessage")
             except requests.exceptions.HTTPError as exc:
                 db.session.rollback()
@@ -332,6 +717,7 @@ def new_conversation():
                 external_id=external_id,
                 is_read=True,
             )
+            conversation.register_message(message)
             db.session.add(message)
 
         db.session.commit()
@@ -341,9 +727,50 @@ def new_conversation():
     return render_template("new_conversation.html")
 
 
+def upsert_conversation(
+    chat_id: str, contact_name: str, sent_at: datetime, sender_type: str, message_text: str
+) -> int:
+    """
+    Crea o actualiza la conversación de chat_id con un único INSERT ... ON CONFLICT.
+    """
+    stmt = sqlite_insert(Conversation).values(
+        contact_number=chat_id,
+        contact_name=contact_name,
+        created_at=sent_at,
+        updated_at=func.now(),
+        last_message_text=message_text,
+        last_message_sender=sender_type,
+        last_message_sent_at=sent_at,
+    )
+    # Igual que Conversation.register_message: un webhook atrasado no pisa el último mensaje.
+    is_newer = or_(
+        Conversation.last_message_sent_at.is_(None),
+        Conversation.last_message_sent_at <= stmt.excluded.last_message_sent_at,
+    )
+    last_message_columns = ("last_message_text", "last_message_sender", "last_message_sent_at")
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Conversation.contact_number],
+        set_={
+            "updated_at": stmt.excluded.updated_at,
+            **{
+                column: case(
+                    (is_newer, stmt.excluded[column]), else_=Conversation.__table__.c[column]
+                )
+                for column in last_message_columns
+            },
+        },
+    ).returning(Conversation.id)
+    return db.session.execute(stmt).scalar_one()
+
+
 @app.post("/webhook/green")
 def green_webhook():
-    payload = request.get_json(silent=True) or {}
+    try:
+        payload = orjson.loads(request.get_data(cache=False)) if request.is_json else {}
+    except orjson.JSONDecodeError:
+        payload = {}
+    if not isinstance(payload, dict):
+        payload = {}
     print("Payload recibido:", payload, flush=True)
     app.logger.info("Webhook recibido: type=%s id=%s", payload.get("typeWebhook"), payload.get("idMessage"))
     webhook_type = payload.get("typeWebhook")
@@ -378,29 +805,17 @@ def handle_incoming_message(payload: dict):
     timestamp = payload.get("timestamp")
     sent_at = datetime.utcfromtimestamp(timestamp) if timestamp else datetime.utcnow()
 
-    conversation = Conversation.query.filter_by(contact_number=chat_id).first()
-    if not conversation:
-        conversation = Conversation(
-            contact_number=chat_id,
-            contact_name=contact_name,
-            created_at=sent_at,
-            updated_at=sent_at,
+    conversation_id = upsert_conversation(chat_id, contact_name, sent_at, "customer", message_text)
+    db.session.execute(
+        insert(Message).values(
+            conversation_id=conversation_id,
+            sender_type="customer",
+            message_text=message_text,
+            sent_at=sent_at,
+            external_id=external_id,
+            is_read=False,
         )
-        db.session.add(conversation)
-        db.session.flush()
-
-    message = Message(
-        conversation_id=conversation.id,
-        sender_type="customer",
-        message_text=message_text,
-        sent_at=sent_at,
-        external_id=external_id,
-        is_read=False,
     )
-
-    conversation.updated_at = datetime.utcnow()
-
-    db.session.add(message)
     db.session.commit()
 
     return jsonify({"status": "received", "content_type": content_type}), 200
@@ -420,19 +835,10 @@ def handle_outgoing_message(payload: dict):
     if not (chat_id and message_text):
         return jsonify({"status": "ignored", "detail": "Mensaje saliente sin datos"}), 200
 
-    conversation = Conversation.query.filter_by(contact_number=chat_id).first()
-    if not conversation:
-        conversation = Conversation(
-            contact_number=chat_id,
-            contact_name=chat_id,
-            created_at=sent_at,
-            updated_at=sent_at,
-        )
-        db.session.add(conversation)
-        db.session.flush()
+    conversation_id = upsert_conversation(chat_id, chat_id, sent_at, "agent", message_text)
 
     existing_message = (
-        Message.query.filter_by(external_id=external_id, conversation_id=conversation.id)
+        Message.query.filter_by(external_id=external_id, conversation_id=conversation_id)
         .order_by(Message.id.desc())
         .first()
     )
@@ -441,17 +847,17 @@ def handle_outgoing_message(payload: dict):
         existing_message.sent_at = sent_at
         existing_message.is_read = True
     else:
-        message = Message(
-            conversation_id=conversation.id,
-            sender_type="agent",
-            message_text=message_text,
-            sent_at=sent_at,
-            external_id=external_id,
-            is_read=True,
+        db.session.execute(
+            insert(Message).values(
+                conversation_id=conversation_id,
+                sender_type="agent",
+                message_text=message_text,
+                sent_at=sent_at,
+                external_id=external_id,
+                is_read=True,
+            )
         )
-        db.session.add(message)
 
-    conversation.updated_at = datetime.utcnow()
     db.session.commit()
 
     return jsonify({"status": "stored"}), 200
@@ -475,8 +881,10 @@ def handle_outgoing_status(payload: dict):
 
 @app.get("/api/conversations")
 def api_conversations():
-    conversations = Conversation.query.order_by(Conversation.updated_at.desc()).all()
-    data = [conversation_to_dict(conversation) for conversation in conversations]
+    data = [
+        conversation_to_dict(conversation, unread_count)
+        for conversation, unread_count in conversations_overview()
+    ]
     return jsonify({"conversations": data})
 
 
@@ -485,6 +893,9 @@ def api_conversation_messages(conversation_id: int):
     conversation = Conversation.query.get_or_404(conversation_id)
     after_id = request.args.get("after_id", default=0, type=int)
     mark_read = request.args.get("mark_read", default="0").lower() in {"1", "true", "yes"}
+    pending_ids = [
+        int(value) for value in request.args.get("pending_ids", "").split(",") if value.isdigit()
+    ][:MESSAGES_PAGE_SIZE]
 
     messages_query = (
         Message.query.filter(
@@ -508,9 +919,22 @@ def api_conversation_messages(conversation_id: int):
     if changed:
         db.session.commit()
 
+    statuses = []
+    if pending_ids:
+        if fail_stale_pending_messages(conversation.id, pending_ids):
+            db.session.commit()
+        statuses = [
+            {"id": message_id, "status": status}
+            for message_id, status in db.session.query(Message.id, Message.status).filter(
+                Message.conversation_id == conversation.id,
+                Message.id.in_(pending_ids),
+            )
+        ]
+
     return jsonify(
         {
             "messages": serialized,
+            "statuses": statuses,
             "last_id": last_id,
             "unread_count": conversation.unread_count(),
             "updated_at": conversation.updated_at.isoformat() if conversation.updated_at else None,
@@ -563,14 +987,29 @@ def handle_errors(exc):
     return render_template("error.html", message=description, code=code), code
 
 
-@app.route("/health")
+@app.route("/health", provide_automatic_options=False)
 def health_check():
+    # SELECT 1 directo: comprueba SQLite sin pasar por el ORM.
+    try:
+        db.session.execute(text("SELECT 1"))
+    except Exception as exc:  # noqa: BLE001
+        app.logger.error("Health check sin base de datos: %s", exc)
+        return jsonify({"status": "degraded"}), 503
     return jsonify({"status": "ok"}), 200
 
 
+@app.cli.command("init-db")
+def init_db_command():
+    """Crea las tablas y aplica las migraciones pendientes."""
+    ensure_database()
+
+
 if __name__ == "__main__":
     ensure_database()
+    if os.environ.get("FLASK_ENV") != "development":
+        app.logger.warning("Servidor de desarrollo de Flask; en producción usa: gunicorn wsgi:app")
     app.run(debug=os.environ.get("FLASK_ENV") == "development", host="0.0.0.0", port=5000)
-else:
+elif not os.environ.get("INBOX_SKIP_MIGRATIONS"):
+    # gunicorn migra una sola vez en on_starting; los workers no deben repetirlo en paralelo.
     ensure_database()
 
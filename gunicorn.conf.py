@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+
+# Workers gevent: mientras una petición espera a Green API (HTTP), el worker
+# atiende otras. Las consultas a SQLite son llamadas C bloqueantes y no ceden.
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = "gevent"
+workers = int(os.environ.get("GUNICORN_WORKERS", "2"))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "500"))
+timeout = 30
+wsgi_app = "wsgi:app"
+
+# Las migraciones se aplican una vez en on_starting; los workers no las repiten.
+os.environ["INBOX_SKIP_MIGRATIONS"] = "1"
+
+
+def on_starting(server):
+    # En un proceso aparte para no importar app (requests, ssl) en el master antes
+    # de que los workers gevent apliquen el monkey-patching.
+    subprocess.run(
+        [sys.executable, "-m", "flask", "--app", "app", "init-db"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        check=True,
+    )
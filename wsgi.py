@@ -0,0 +1,4 @@
+"""
+Punto de entrada WSGI para producción: gunicorn wsgi:app (ver gunicorn.conf.py).
+"""
+from app import app  # noqa: F401